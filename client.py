@@ -6,6 +6,7 @@ from tkinter import messagebox
 import socket
 import threading
 import json
+from protocol import split_messages
 
 class Const(Enum):
     OFFSET = 100
@@ -173,6 +174,10 @@ class OnlineClient:
         self.connected = False
         self.player_symbol = None
         self.room_id = None
+        self.next_seq = 0
+        # Буфер предсказаний: seq -> (row, col) ходов, которые сервер еще не подтвердил.
+        # Меняется только из потока Tk (через root.after)
+        self.pending = {}
         
     def connect(self):
         try:
@@ -191,20 +196,23 @@ class OnlineClient:
             return False
     
     def receive_messages(self):
+        buffer = ''
         while self.connected:
             try:
                 data = self.socket.recv(1024).decode('utf-8')
                 if not data:
                     break
                 
-                message = json.loads(data)
-                self.process_message(message)
+                messages, buffer = split_messages(buffer + data)
+                for message in messages:
+                    self.process_message(message)
                 
             except:
                 break
         
         self.connected = False
         if self.game_view:
+            self.game_view.root.after(0, self.pending.clear)
             self.game_view.root.after(0, lambda: messagebox.showinfo(
                 "Disconnected", "Disconnected from server"))
     
@@ -228,8 +236,14 @@ class OnlineClient:
             row, col, symbol = message['row'], message['col'], message['symbol']
             
             # Отмечаем клетку на доске
-            cell = self.game_view.logic.cells[row][col]
-            self.game_view.root.after(0, lambda: cell.mark(symbol))
+            self.game_view.root.after(0, lambda: self.apply_move(row, col, symbol))
+            
+        elif msg_type == 'move_ack':
+            seq = message['seq']
+            self.game_view.root.after(0, lambda: self.confirm_move(seq))
+            
+        elif msg_type == 'move_rejected':
+            self.game_view.root.after(0, lambda: self.rollback_move(message))
             
         elif msg_type == 'turn_change':
             self.game_view.logic.my_turn = (message['turn'] == self.player_symbol)
@@ -247,12 +261,14 @@ class OnlineClient:
                 self.game_view.root.after(0, lambda: messagebox.showinfo("Game Over", "You lost!"))
                 self.game_view.logic.cpu_score += 1
             
-            self.game_view.root.after(0, lambda: self.game_view.reset_board())
+            self.game_view.root.after(0, lambda: self.reset_board())
             
         elif msg_type == 'game_reset':
-            self.game_view.root.after(0, lambda: self.game_view.reset_board())
+            self.game_view.root.after(0, lambda: self.reset_board())
             
         elif msg_type == 'opponent_disconnected':
+            # Неподтвержденные ходы уже никто не подтвердит
+            self.game_view.root.after(0, self.pending.clear)
             self.game_view.root.after(0, lambda: messagebox.showinfo(
                 "Opponent left", "Opponent disconnected"))
             self.game_view.logic.is_online = False
@@ -261,22 +277,66 @@ class OnlineClient:
             self.game_view.root.after(0, lambda: messagebox.showerror("Error", message['message']))
     
     def send_move(self, row, col):
+        """Отправляет ход и возвращает его seq (None, если отправить не удалось)"""
         if not self.connected:
-            return False
+            return None
         
+        self.next_seq += 1
         try:
             message = {
                 'type': 'move',
                 'row': row,
-                'col': col
+                'col': col,
+                'seq': self.next_seq
             }
             self.socket.send(json.dumps(message).encode('utf-8'))
-            return True
+            return self.next_seq
         except:
+            return None
+    
+    def predict_move(self, row, col):
+        """Отправляет ход и сразу отмечает его на доске, не дожидаясь сервера"""
+        seq = self.send_move(row, col)
+        if seq is None:
             return False
+        
+        self.pending[seq] = (row, col)
+        self.game_view.logic.cells[row][col].mark(self.player_symbol)
+        return True
+    
+    def confirm_move(self, seq):
+        # Сервер обрабатывает ходы по порядку, поэтому подтверждены и все более ранние
+        for acked in [s for s in self.pending if s <= seq]:
+            del self.pending[acked]
+    
+    def rollback_move(self, message):
+        move = self.pending.pop(message['seq'], None)
+        if move:
+            row, col = move
+            cell = self.game_view.logic.cells[row][col]
+            # Клетку мог уже занять соперник - тогда на ней его символ
+            if cell.getMarker() == self.player_symbol:
+                cell.unmark()
+        
+        self.game_view.logic.my_turn = (message['turn'] == self.player_symbol)
+        self.game_view.update_status(
+            f"{'Your turn' if self.game_view.logic.my_turn else 'Opponent turn'}")
+        messagebox.showerror("Error", message['message'])
+    
+    def apply_move(self, row, col, symbol):
+        cell = self.game_view.logic.cells[row][col]
+        # Сервер главнее предсказания: заменяем чужой символ на подтвержденный
+        if cell.getMarker() != symbol:
+            cell.unmark()
+        cell.mark(symbol)
+    
+    def reset_board(self):
+        self.pending.clear()
+        self.game_view.reset_board()
     
     def disconnect(self):
         self.connected = False
+        self.pending.clear()
         if self.socket:
             self.socket.close()
 
@@ -438,10 +498,8 @@ class GameView:
             if self.logic.cells[i][j].getMarker() != Const.EMPTY_CHAR.value:
                 return
             
-            # Отправляем ход на сервер
-            if self.online_client.send_move(i, j):
-                # Временно отмечаем клетку (сервер подтвердит)
-                self.logic.cells[i][j].mark(self.logic.player_symbol)
+            # Отправляем ход на сервер и сразу показываем его (сервер подтвердит или откатит)
+            if self.online_client.predict_move(i, j):
                 self.logic.my_turn = False
                 self.update_status("Waiting for opponent...")
             return
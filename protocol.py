@@ -0,0 +1,50 @@
+import json
+import re
+
+# Общий для клиента и сервера разбор потока сообщений: TCP может склеить
+# несколько JSON-сообщений в один recv или разрезать одно на части
+
+# Больше этого недочитанного хвоста честный клиент не присылает
+MAX_BUFFER = 64 * 1024
+
+# Хвосты, которые еще могут стать валидным JSON, когда дойдут остальные байты
+_NUMBER_TAIL = re.compile(r'[-+.eE0-9]*')
+_ESCAPE_TAIL = re.compile(r'u[0-9a-fA-F]{0,4}')
+
+class ProtocolError(ValueError):
+    """Поток содержит не JSON-объект - соединение дальше не разобрать"""
+
+def _truncated(buffer, error):
+    rest = buffer[error.pos:]
+    if error.msg.startswith('Unterminated string'):
+        return True
+    if error.msg.startswith('Invalid \\uXXXX escape'):
+        return bool(_ESCAPE_TAIL.fullmatch(rest))
+    return (_NUMBER_TAIL.fullmatch(rest) is not None
+            or any(word.startswith(rest) for word in ('true', 'false', 'null')))
+
+def split_messages(buffer):
+    """Разбирает склеенные JSON-сообщения, возвращает (сообщения, остаток).
+
+    Остаток - начало еще не дошедшего сообщения. Если данные не могут быть
+    началом JSON-объекта или остаток больше MAX_BUFFER, бросает ProtocolError.
+    """
+    decoder = json.JSONDecoder()
+    messages = []
+    pos = 0
+    while True:
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos >= len(buffer):
+            return messages, ''
+        if buffer[pos] != '{':
+            raise ProtocolError(f"Unexpected data: {buffer[pos:pos + 20]!r}")
+        try:
+            message, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if not _truncated(buffer, e):
+                raise ProtocolError(f"Malformed message: {e}") from None
+            if len(buffer) - pos > MAX_BUFFER:
+                raise ProtocolError("Message too long") from None
+            return messages, buffer[pos:]
+        messages.append(message)
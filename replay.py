@@ -0,0 +1,232 @@
+import argparse
+import json
+import socket
+import threading
+import time
+from protocol import ProtocolError, split_messages
+from server import GameServer, load_capture
+
+# Воспроизведение записанного трафика сервера (см. GameServer --capture)
+
+# В записи сервера payload подключения - адрес клиента, в логе прогона - эта метка.
+# По ней отличаем задержки на стороне сервера от задержек полного круга у клиента
+REPLAY_MARK = 'replay'
+
+class Replayer:
+    """Прогоняет запись через сервер и собирает лог в том же формате.
+
+    Перед каждым входящим кадром ждем, пока каждое соединение получит столько же
+    кадров, сколько получило к этому моменту в записи - так порядок событий
+    детерминирован и в режиме "как можно быстрее".
+    """
+    def __init__(self, events, host='127.0.0.1', port=5555, realtime=False, timeout=5.0):
+        self.events = events
+        self.host = host
+        self.port = port
+        self.realtime = realtime
+        self.timeout = timeout
+        self.sockets = {}  # conn_id -> socket
+        self.received = {}  # conn_id -> количество полученных кадров
+        self.log = []  # [t, direction, conn_id, payload]
+        self.cond = threading.Condition()
+        self.stalls = 0
+        self.start_time = None
+        self.finished = False
+
+    def run(self):
+        self.start_time = time.monotonic()
+        expected = {}
+
+        for t, direction, conn_id, payload in self.events:
+            if direction == 'o':
+                expected[conn_id] = expected.get(conn_id, 0) + 1
+                continue
+
+            self.wait_for(expected)
+            if self.realtime:
+                delay = self.start_time + t - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if direction == 'c':
+                self.connect(conn_id)
+            elif direction == 'i' and conn_id in self.sockets:
+                self.record('i', conn_id, payload)
+                self.sockets[conn_id].sendall(payload.encode('utf-8'))
+            elif direction == 'd' and conn_id in self.sockets:
+                self.record('d', conn_id)
+                self.disconnect(self.sockets.pop(conn_id))
+
+        self.wait_for(expected)
+        # Запись могла кончиться при открытых соединениях; ответы сервера на наше
+        # закрытие в ней отсутствуют, поэтому в лог прогона их не пишем
+        with self.cond:
+            self.finished = True
+        for sock in self.sockets.values():
+            self.disconnect(sock)
+        self.sockets = {}
+
+        with self.cond:
+            return sorted(self.log, key=lambda event: event[0])
+
+    def connect(self, conn_id):
+        sock = socket.create_connection((self.host, self.port))
+        self.record('c', conn_id, REPLAY_MARK)
+        self.sockets[conn_id] = sock
+        thread = threading.Thread(target=self.receive, args=(sock, conn_id))
+        thread.daemon = True
+        thread.start()
+
+    def disconnect(self, sock):
+        # Без shutdown закрытие не дойдет до сервера, пока поток приема висит в recv
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def receive(self, sock, conn_id):
+        buffer = ''
+        try:
+            while True:
+                data = sock.recv(1024).decode('utf-8')
+                if not data:
+                    break
+                messages, buffer = split_messages(buffer + data)
+                for message in messages:
+                    with self.cond:
+                        if self.finished:
+                            return
+                        self.record('o', conn_id, json.dumps(message))
+                        self.received[conn_id] = self.received.get(conn_id, 0) + 1
+                        self.cond.notify_all()
+        except (OSError, ProtocolError):
+            pass
+
+    def wait_for(self, expected):
+        done = lambda: all(self.received.get(conn_id, 0) >= count
+                           for conn_id, count in expected.items())
+        with self.cond:
+            if not self.cond.wait_for(done, timeout=self.timeout):
+                self.stalls += 1
+
+    def record(self, direction, conn_id, payload=''):
+        with self.cond:
+            t = round(time.monotonic() - self.start_time, 6)
+            self.log.append([t, direction, conn_id, payload])
+
+def outputs_by_conn(events):
+    outputs = {}
+    for _, direction, conn_id, payload in events:
+        if direction == 'o':
+            outputs.setdefault(conn_id, []).append(json.loads(payload))
+    return outputs
+
+def is_replay_log(events):
+    return any(direction == 'c' and payload == REPLAY_MARK
+               for _, direction, _, payload in events)
+
+def latencies(events):
+    """Время от входящего кадра (или подключения) до первого ответа сервера.
+
+    В записи сервера это время обработки внутри процесса (от recv до send),
+    в логе прогона - полный круг у клиента (от send до recv).
+    """
+    result = []
+    pending = []
+    for t, direction, _, _ in events:
+        if direction in ('c', 'i'):
+            pending.append(t)
+        elif direction == 'o' and pending:
+            result.extend(t - sent for sent in pending)
+            pending = []
+    return result
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def print_latency_header():
+    print(f"{'':>10}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+
+def print_latency_row(name, events):
+    values = latencies(events)
+    row = [percentile(values, p) * 1000 for p in (50, 90, 99, 100)]
+    print(f"{name:>10}{len(values):>8}" + ''.join(f"{v:>10.3f}" for v in row))
+
+def compare(baseline, run):
+    """Печатает расхождения ответов и распределения задержек, возвращает число расхождений"""
+    expected, actual = outputs_by_conn(baseline), outputs_by_conn(run)
+    mismatches = 0
+    for conn_id in sorted(set(expected) | set(actual), key=str):
+        want, got = expected.get(conn_id, []), actual.get(conn_id, [])
+        for index in range(max(len(want), len(got))):
+            a = want[index] if index < len(want) else None
+            b = got[index] if index < len(got) else None
+            if a != b:
+                mismatches += 1
+                print(f"conn {conn_id} frame {index}: expected {a}, got {b}")
+
+    if is_replay_log(baseline):
+        print("Round-trip latency (client send -> first server frame):")
+        rows = (('baseline', baseline), ('replay', run))
+    else:
+        # Задержки записи и прогона измерены в разных точках - не сравниваем их
+        print("Server-side handling time from the capture (informational, not comparable):")
+        print_latency_header()
+        print_latency_row('capture', baseline)
+        print("Round-trip latency of this replay (compare runs with --save/--baseline):")
+        rows = (('replay', run),)
+    print_latency_header()
+    for name, events in rows:
+        print_latency_row(name, events)
+    print(f"Output mismatches: {mismatches}")
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a game server")
+    parser.add_argument('capture', help="файл, записанный server.py --capture")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--spawn', action='store_true',
+                        help="запустить сервер в этом процессе (с --port 0 - на свободном порту)")
+    parser.add_argument('--realtime', action='store_true',
+                        help="соблюдать исходные интервалы между кадрами")
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help="сколько ждать ожидаемых ответов сервера, секунд")
+    parser.add_argument('--baseline', metavar='PATH',
+                        help="сравнивать с этим прогоном (--save) вместо исходной записи; "
+                             "задержки сравниваются только между прогонами")
+    parser.add_argument('--save', metavar='PATH', help="сохранить лог прогона")
+    args = parser.parse_args()
+
+    events = load_capture(args.capture)
+    baseline = load_capture(args.baseline) if args.baseline else events
+
+    if args.spawn:
+        server = GameServer(args.host, args.port)
+        server.listen()
+        thread = threading.Thread(target=server.serve)
+        thread.daemon = True
+        thread.start()
+        args.port = server.port
+
+    replayer = Replayer(events, args.host, args.port, realtime=args.realtime,
+                        timeout=args.timeout)
+    run = replayer.run()
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            for event in run:
+                f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+    if replayer.stalls:
+        print(f"Timed out waiting for server output {replayer.stalls} time(s)")
+    mismatches = compare(baseline, run)
+    return 1 if mismatches or replayer.stalls else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,15 +1,67 @@
 import socket
 import threading
 import json
+import time
+import argparse
+import os
+import selectors
+import struct
+from contextlib import contextmanager
 from enum import Enum
+from protocol import split_messages
+
+# Сколько дескрипторов передавать в одном сообщении SCM_RIGHTS (в Linux не больше 253)
+HANDOFF_MAX_FDS = 200
+# Сколько ждать клиента, который перестал читать, прежде чем бросить отправку
+SEND_TIMEOUT = 5
 
 class GameState(Enum):
     WAITING = "waiting"
     PLAYING = "playing"
     FINISHED = "finished"
 
+class TrafficCapture:
+    """Записывает входящие и исходящие кадры сервера в файл.
+
+    Каждая строка файла - компактный JSON-массив [t, direction, conn_id, payload],
+    где t - секунды от начала записи, direction: 'c' - подключение,
+    'i' - входящий кадр, 'o' - исходящий кадр, 'd' - отключение.
+    Если передан started_at (время начала записи по time.time()), файл дописывается
+    и отсчет продолжается - так запись переживает передачу сервера новому процессу.
+    """
+    def __init__(self, path, started_at=None):
+        self.path = os.path.abspath(path)
+        self.file = open(path, 'w' if started_at is None else 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.started_at = time.time() if started_at is None else started_at
+        self.start_time = time.monotonic() - (time.time() - self.started_at)
+
+    def record(self, direction, conn_id, payload=''):
+        t = round(time.monotonic() - self.start_time, 6)
+        line = json.dumps([t, direction, conn_id, payload], separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def load_capture(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff connection closed")
+        data += chunk
+    return data
+
 class GameServer:
-    def __init__(self, host='127.0.0.1', port=5555):
+    def __init__(self, host='127.0.0.1', port=5555, capture_path=None, handoff_path=None):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -20,47 +72,270 @@ class GameServer:
         self.board = [[' ' for _ in range(3)] for _ in range(3)]
         self.current_turn = 'X'
         self.game_state = GameState.WAITING
+        self.capture_path = capture_path
+        self.capture = None
+        self.conn_ids = {}  # socket -> conn_id для записи трафика
+        self.next_conn_id = 0
+        self.buffers = {}  # socket -> недочитанный хвост входящих данных
+        # Управляющий unix-сокет: через него новый процесс забирает игры и соединения
+        self.handoff_path = handoff_path
+        self.control_socket = None
+        # Файл handoff_path удаляет при выходе только процесс, которому он принадлежит
+        self.owns_control = False
+        # Все изменения состояния идут под этой блокировкой; draining выставляется
+        # под ней же, после этого потоки клиентов больше не читают из сокетов.
+        # Сообщения под блокировкой не отправляются - см. locked()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.draining = False
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.handlers = {}  # socket -> поток обработки клиента
         
-    def start(self):
+    def start(self, takeover=False):
+        if takeover:
+            self.take_over()
+        else:
+            self.listen()
+        self.serve()
+
+    def listen(self):
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
+        self.port = self.server_socket.getsockname()[1]
         print(f"Server started on {self.host}:{self.port}")
         
-        while True:
-            client_socket, address = self.server_socket.accept()
-            print(f"New connection from {address}")
+        if self.capture_path:
+            self.capture = TrafficCapture(self.capture_path)
+        
+        if self.handoff_path:
+            if os.path.exists(self.handoff_path):
+                os.unlink(self.handoff_path)
+            self.control_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.control_socket.bind(self.handoff_path)
+            self.control_socket.listen(1)
+            self.owns_control = True
+            print(f"Waiting for handoff on {self.handoff_path}")
+
+    def serve(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.server_socket, selectors.EVENT_READ)
+            if self.control_socket:
+                selector.register(self.control_socket, selectors.EVENT_READ)
             
-            # Создаем комнату или добавляем во вторую
-            if len(self.clients) % 2 == 0:
-                # Первый игрок в комнате
-                player_symbol = 'X'
-                room_id = len(self.clients) // 2
-                self.rooms[room_id] = [client_socket]
-                print(f"Created room {room_id} for player X")
-            else:
-                # Второй игрок в комнате
-                player_symbol = 'O'
-                room_id = (len(self.clients) - 1) // 2
-                self.rooms[room_id].append(client_socket)
-                print(f"Added player O to room {room_id}")
+            while True:
+                readable = [key.fileobj for key, _ in selector.select()]
                 
-                # Запускаем игру в комнате
-                self.start_game(room_id)
-            
-            self.clients.append((client_socket, address, player_symbol))
+                # Новый процесс пришел за состоянием - перестаем принимать и отдаем все ему
+                if self.control_socket in readable:
+                    conn, _ = self.control_socket.accept()
+                    if self.hand_off(conn):
+                        return
+                    continue
+                
+                client_socket, address = self.server_socket.accept()
+                with self.locked():
+                    self.add_client(client_socket, address)
+
+    @contextmanager
+    def locked(self):
+        """Берет блокировку состояния; сообщения уходят клиентам уже после ее снятия,
+        чтобы клиент, переставший читать, не останавливал остальные игры"""
+        self.local.outbox = []
+        try:
+            with self.lock:
+                yield
+        finally:
+            outbox, self.local.outbox = self.local.outbox, None
+            for client_socket, data in outbox:
+                self.deliver(client_socket, data)
+
+    def add_client(self, client_socket, address):
+        print(f"New connection from {address}")
+        client_socket.settimeout(SEND_TIMEOUT)
+        
+        self.conn_ids[client_socket] = self.next_conn_id
+        self.next_conn_id += 1
+        self.record('c', client_socket, f"{address[0]}:{address[1]}")
+        
+        # Создаем комнату или добавляем во вторую
+        if len(self.clients) % 2 == 0:
+            # Первый игрок в комнате
+            player_symbol = 'X'
+            room_id = len(self.clients) // 2
+            self.rooms[room_id] = [client_socket]
+            print(f"Created room {room_id} for player X")
+        else:
+            # Второй игрок в комнате
+            player_symbol = 'O'
+            room_id = (len(self.clients) - 1) // 2
+            self.rooms[room_id].append(client_socket)
+            print(f"Added player O to room {room_id}")
             
-            # Отправляем игроку его символ
-            self.send_message(client_socket, {
-                'type': 'assign_symbol',
+            # Запускаем игру в комнате
+            self.start_game(room_id)
+        
+        self.clients.append((client_socket, address, player_symbol))
+        
+        # Отправляем игроку его символ
+        self.send_message(client_socket, {
+            'type': 'assign_symbol',
+            'symbol': player_symbol,
+            'room_id': room_id
+        })
+        
+        self.start_handler(client_socket, player_symbol, room_id)
+
+    def start_handler(self, client_socket, player_symbol, room_id):
+        # Запускаем поток для обработки сообщений от клиента
+        thread = threading.Thread(target=self.handle_client, 
+                                 args=(client_socket, player_symbol, room_id))
+        thread.daemon = True
+        self.handlers[client_socket] = thread
+        thread.start()
+
+    def start_handlers(self):
+        for client_socket, _, player_symbol in self.clients:
+            self.start_handler(client_socket, player_symbol, self.room_of(client_socket))
+
+    def room_of(self, client_socket):
+        return next((room_id for room_id, players in self.rooms.items()
+                     if client_socket in players), None)
+
+    def hand_off(self, conn):
+        """Передает новому процессу снимок состояния, слушающий сокет и соединения.
+
+        Новый процесс восстанавливает состояние и отвечает 'OK', но начинает работу
+        только после нашего 'GO'. Ждем 'OK' с таймаутом только мы: не дождались -
+        закрываем соединение без 'GO' и продолжаем сами, так что сокеты клиентов
+        никогда не читают два процесса сразу.
+        """
+        with self.lock:
+            self.draining = True
+            # Будим потоки клиентов, чтобы они вышли, не читая из сокетов
+            self.wakeup_w.send(b'x')
+            snapshot, sockets = self.snapshot()
+        
+        # Дожидаемся, пока потоки клиентов допишут уже обработанные ответы
+        for thread in list(self.handlers.values()):
+            thread.join()
+        
+        fds = [sock.fileno() for sock in sockets]
+        snapshot['fd_count'] = len(fds)
+        data = json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+        
+        # Новый процесс подтверждает, только когда восстановил состояние
+        conn.settimeout(10)
+        try:
+            conn.sendall(struct.pack('!I', len(data)) + data)
+            for i in range(0, len(fds), HANDOFF_MAX_FDS):
+                socket.send_fds(conn, [b'F'], fds[i:i + HANDOFF_MAX_FDS])
+            confirmed = recv_exact(conn, 2) == b'OK'
+            if confirmed:
+                conn.sendall(b'GO')
+        except OSError:
+            confirmed = False
+        conn.close()
+        
+        if not confirmed:
+            # Без подтверждения игры остаются у нас: продолжаем как ни в чем не бывало
+            with self.lock:
+                self.draining = False
+                self.wakeup_r.recv(16)
+                self.start_handlers()
+            print("Handoff was not confirmed by the new process, resuming")
+            return False
+        
+        self.owns_control = False
+        print(f"Handed off {len(self.clients)} connection(s) and {len(self.rooms)} room(s)")
+        return True
+
+    def snapshot(self):
+        # Порядок дескрипторов: слушающий сокет, управляющий сокет, затем клиенты
+        sockets = [self.server_socket, self.control_socket]
+        index = {}
+        clients = []
+        for client_socket, address, player_symbol in self.clients:
+            index[client_socket] = len(clients)
+            clients.append({
+                'address': list(address),
                 'symbol': player_symbol,
-                'room_id': room_id
+                'conn_id': self.conn_ids.get(client_socket),
+                'buffer': self.buffers.get(client_socket, '')
             })
+            sockets.append(client_socket)
+        
+        snapshot = {
+            'board': self.board,
+            'current_turn': self.current_turn,
+            'game_state': self.game_state.value,
+            'next_conn_id': self.next_conn_id,
+            'capture': [self.capture.path, self.capture.started_at] if self.capture else None,
+            'clients': clients,
+            'rooms': {str(room_id): [index[p] for p in players]
+                      for room_id, players in self.rooms.items()}
+        }
+        return snapshot, sockets
+
+    def take_over(self):
+        """Забирает состояние и сокеты у работающего процесса через handoff_path"""
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.handoff_path)
+        
+        # При любой ошибке до 'GO' просто выходим: старый процесс продолжит игры сам
+        try:
+            size, = struct.unpack('!I', recv_exact(conn, 4))
+            snapshot = json.loads(recv_exact(conn, size).decode('utf-8'))
+            fds = []
+            while len(fds) < snapshot['fd_count']:
+                msg, new_fds, _, _ = socket.recv_fds(conn, 1, HANDOFF_MAX_FDS)
+                if not msg:
+                    raise ConnectionError("Handoff connection closed")
+                fds.extend(new_fds)
+            if len(fds) != snapshot['fd_count'] or len(fds) != len(snapshot['clients']) + 2:
+                raise ValueError(f"Handoff snapshot does not match {len(fds)} received descriptor(s)")
+            self.restore(snapshot, fds)
             
-            # Запускаем поток для обработки сообщений от клиента
-            thread = threading.Thread(target=self.handle_client, 
-                                     args=(client_socket, player_symbol, room_id))
-            thread.daemon = True
-            thread.start()
+            conn.sendall(b'OK')
+            # Ждем без таймаута: старый процесс либо пришлет 'GO', либо закроет соединение
+            conn.settimeout(None)
+            if recv_exact(conn, 2) != b'GO':
+                raise ConnectionError("Handoff was not committed by the old process")
+        finally:
+            conn.close()
+        
+        # Читать из сокетов начинаем только после того, как старый процесс отказался от них
+        self.owns_control = True
+        self.start_handlers()
+
+    def restore(self, snapshot, fds):
+        self.server_socket.close()
+        self.server_socket = socket.socket(fileno=fds[0])
+        self.control_socket = socket.socket(fileno=fds[1])
+        self.port = self.server_socket.getsockname()[1]
+        
+        self.board = snapshot['board']
+        self.current_turn = snapshot['current_turn']
+        self.game_state = GameState(snapshot['game_state'])
+        self.next_conn_id = snapshot['next_conn_id']
+        
+        if self.capture_path:
+            # Та же запись - дописываем ее, не сбрасывая время; иначе начинаем новую
+            started_at = None
+            if snapshot['capture'] and snapshot['capture'][0] == os.path.abspath(self.capture_path):
+                started_at = snapshot['capture'][1]
+            self.capture = TrafficCapture(self.capture_path, started_at)
+        
+        sockets = [socket.socket(fileno=fd) for fd in fds[2:]]
+        for info, client_socket in zip(snapshot['clients'], sockets):
+            client_socket.settimeout(SEND_TIMEOUT)
+            self.clients.append((client_socket, tuple(info['address']), info['symbol']))
+            self.conn_ids[client_socket] = info['conn_id']
+            self.buffers[client_socket] = info['buffer']
+        self.rooms = {int(room_id): [sockets[i] for i in players]
+                      for room_id, players in snapshot['rooms'].items()}
+        
+        print(f"Server resumed on {self.host}:{self.port} with {len(self.clients)} "
+              f"connection(s) and {len(self.rooms)} room(s)")
     
     def start_game(self, room_id):
         """Начинает игру в комнате"""
@@ -81,45 +356,70 @@ class GameServer:
     
     # Обработка сообщений от клиента
     def handle_client(self, client_socket, player_symbol, room_id):
+        # select.select не работает с дескрипторами >= 1024, поэтому selectors
+        selector = selectors.DefaultSelector()
+        selector.register(client_socket, selectors.EVENT_READ)
+        selector.register(self.wakeup_r, selectors.EVENT_READ)
         try:
             while True:
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                
-                message = json.loads(data)
-                self.process_message(message, client_socket, player_symbol, room_id)
+                selector.select()
+                with self.locked():
+                    # Соединение передано новому процессу: не читаем и не закрываем
+                    if self.draining:
+                        return
+                    
+                    data = client_socket.recv(1024).decode('utf-8')
+                    if not data:
+                        break
+                    
+                    self.record('i', client_socket, data)
+                    # Клиент может прислать несколько ходов подряд, не дожидаясь ответа
+                    messages, buffer = split_messages(self.buffers.get(client_socket, '') + data)
+                    self.buffers[client_socket] = buffer
+                    for message in messages:
+                        self.process_message(message, client_socket, player_symbol, room_id)
                 
         except Exception as e:
             print(f"Error handling client: {e}")
         finally:
-            self.remove_client(client_socket, room_id)
+            selector.close()
+        
+        with self.locked():
+            if not self.draining:
+                self.remove_client(client_socket, room_id)
     
     def process_message(self, message, client_socket, player_symbol, room_id):
         msg_type = message.get('type')
         
         if msg_type == 'move':
+            seq = message.get('seq')
+            
             # Проверяем, что ход правильный
             if player_symbol != self.current_turn:
-                self.send_message(client_socket, {
-                    'type': 'error',
-                    'message': 'Not your turn!'
-                })
+                self.reject_move(client_socket, seq, 'Not your turn!')
                 return
             
             row, col = message['row'], message['col']
             
+            if not (0 <= row < 3 and 0 <= col < 3):
+                self.reject_move(client_socket, seq, 'Invalid cell!')
+                return
+            
             # Проверяем, что клетка свободна
             if self.board[row][col] != ' ':
-                self.send_message(client_socket, {
-                    'type': 'error',
-                    'message': 'Cell already taken!'
-                })
+                self.reject_move(client_socket, seq, 'Cell already taken!')
                 return
             
             # Делаем ход
             self.board[row][col] = player_symbol
             
+            # Подтверждаем ход клиенту, чтобы он снял его из буфера предсказаний
+            if seq is not None:
+                self.send_message(client_socket, {
+                    'type': 'move_ack',
+                    'seq': seq
+                })
+            
             # Отправляем ход всем игрокам в комнате
             for player in self.rooms[room_id]:
                 self.send_message(player, {
@@ -163,6 +463,22 @@ class GameServer:
                     'type': 'game_reset'
                 })
     
+    def reject_move(self, client_socket, seq, text):
+        # Старые клиенты не присылают seq и ждут обычную ошибку
+        if seq is None:
+            self.send_message(client_socket, {
+                'type': 'error',
+                'message': text
+            })
+            return
+        
+        self.send_message(client_socket, {
+            'type': 'move_rejected',
+            'seq': seq,
+            'message': text,
+            'turn': self.current_turn
+        })
+    
     def check_winner(self):
         # Проверка строк
         for row in range(3):
@@ -194,12 +510,35 @@ class GameServer:
         self.current_turn = 'X'
     
     def send_message(self, client_socket, message):
+        data = json.dumps(message)
+        # Пишем до отправки: ответ клиента не должен попасть в запись раньше
+        self.record('o', client_socket, data)
+        outbox = getattr(self.local, 'outbox', None)
+        if outbox is not None:
+            outbox.append((client_socket, data))
+        else:
+            self.deliver(client_socket, data)
+
+    def deliver(self, client_socket, data):
         try:
-            client_socket.send(json.dumps(message).encode('utf-8'))
-        except:
-            pass
+            client_socket.sendall(data.encode('utf-8'))
+        except OSError:
+            # Кадр мог уйти частично - поток для клиента испорчен. Закрываем его,
+            # поток обработки увидит EOF и уберет клиента через remove_client
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def record(self, direction, client_socket, payload=''):
+        if self.capture:
+            self.capture.record(direction, self.conn_ids.get(client_socket), payload)
     
     def remove_client(self, client_socket, room_id):
+        # Отключение пишем до уведомления соперника, чтобы при воспроизведении
+        # порядок кадров совпадал с причиной и следствием
+        self.record('d', client_socket)
+        
         for player in self.rooms.get(room_id, []):
             if player != client_socket:
                 self.send_message(player, {
@@ -212,9 +551,32 @@ class GameServer:
             self.rooms[room_id] = [p for p in self.rooms[room_id] if p != client_socket]
             if not self.rooms[room_id]:
                 del self.rooms[room_id]
+        self.conn_ids.pop(client_socket, None)
+        self.buffers.pop(client_socket, None)
+        self.handlers.pop(client_socket, None)
         
         client_socket.close()
 
 if __name__ == "__main__":
-    server = GameServer()
-    server.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Tic-tac-toe game server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--capture', metavar='PATH',
+                        help="записывать входящий и исходящий трафик в файл")
+    parser.add_argument('--handoff', metavar='PATH',
+                        help="unix-сокет для перезапуска без разрыва соединений")
+    parser.add_argument('--takeover', action='store_true',
+                        help="забрать игры и соединения у процесса, слушающего --handoff")
+    args = parser.parse_args()
+    if args.takeover and not args.handoff:
+        parser.error("--takeover requires --handoff")
+
+    server = GameServer(args.host, args.port, capture_path=args.capture,
+                        handoff_path=args.handoff)
+    try:
+        server.start(takeover=args.takeover)
+    finally:
+        if server.capture:
+            server.capture.close()
+        if server.owns_control:
+            os.unlink(server.handoff_path)